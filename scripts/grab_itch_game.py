@@ -10,14 +10,58 @@ import sys
 import json
 import shutil
 import tempfile
-import urllib.request
 import urllib.parse
 import zipfile
 import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime, timezone
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 
+# Prefer the C-backed lxml parser; fall back to the pure-Python one
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+# Unity loader config entries pointing at Build/ assets, either as literals
+# (dataUrl: "Build/x.data") or relative to buildUrl (dataUrl: buildUrl + "/x.data")
+UNITY_CONFIG_URL_RE = re.compile(
+    r'\b(?:loaderUrl|dataUrl|frameworkUrl|codeUrl)\s*[:=]\s*'
+    r'(buildUrl\s*\+\s*)?["\']([^"\']+)["\']'
+)
+UNITY_BUILD_URL_RE = re.compile(r'\bbuildUrl\s*=\s*["\']([^"\']+)["\']')
+
+# itch.io scripts stripped from the standalone HTML
+ITCH_SCRIPT_RE = re.compile(r'<script[^>]*(?:itch\.io|htmlgame\.js)[^>]*>.*?</script>', re.DOTALL)
+
+# Number of Build/ assets fetched concurrently
+MAX_DOWNLOAD_WORKERS = 8
+
+# Build files are saved exactly as served: Unity's .gz builds are often sent
+# with Content-Encoding: gzip, and decoding them would leave plain bytes under
+# a .gz name
+ASSET_HEADERS = {'Accept-Encoding': 'identity'}
+
+# Times an interrupted asset transfer is retried, resuming with a Range
+# request when the server provides a validator
+MAX_RESUME_ATTEMPTS = 3
+
+# Shared session so the page, index.html and asset requests reuse keep-alive
+# connections to itch.io instead of opening a new TLS connection each time
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=MAX_DOWNLOAD_WORKERS,
+    # Back off (honouring Retry-After) when the CDN throttles or hiccups
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504)),
+))
+
 class Colors:
     RED = '\033[0;31m'
     GREEN = '\033[0;32m'
@@ -25,53 +69,60 @@ class Colors:
     BLUE = '\033[0;34m'
     NC = '\033[0m'  # No Color
 
+# Each line goes out in one write so messages from download workers can't
+# interleave (print() writes the text and the newline separately)
 def print_status(msg):
-    print(f"{Colors.BLUE}[INFO]{Colors.NC} {msg}")
+    sys.stdout.write(f"{Colors.BLUE}[INFO]{Colors.NC} {msg}\n")
 
 def print_success(msg):
-    print(f"{Colors.GREEN}[SUCCESS]{Colors.NC} {msg}")
+    sys.stdout.write(f"{Colors.GREEN}[SUCCESS]{Colors.NC} {msg}\n")
 
 def print_warning(msg):
-    print(f"{Colors.YELLOW}[WARNING]{Colors.NC} {msg}")
+    sys.stdout.write(f"{Colors.YELLOW}[WARNING]{Colors.NC} {msg}\n")
 
 def print_error(msg):
-    print(f"{Colors.RED}[ERROR]{Colors.NC} {msg}")
+    sys.stdout.write(f"{Colors.RED}[ERROR]{Colors.NC} {msg}\n")
 
 def extract_game_name_from_url(url):
     """Extract game name from itch.io URL"""
     # Extract from URL pattern: https://username.itch.io/game-name
-    match = re.search(r'\.itch\.io/([^/?]+)', url)
-    if match:
-        return match.group(1)
+    _, sep, path = url.partition('.itch.io/')
+    if sep:
+        name = path.split('/', 1)[0].split('?', 1)[0]
+        if name:
+            return name
     
     # Fallback: use last part of path
-    return url.rstrip('/').split('/')[-1]
+    return url.rstrip('/').rpartition('/')[2]
 
 def find_embedded_game_url(game_url):
     """Find the embedded HTML5 game URL from the itch.io page"""
     print_status(f"Fetching game page: {game_url}")
     
     try:
-        with urllib.request.urlopen(game_url) as response:
-            html = response.read().decode('utf-8')
+        response = SESSION.get(game_url, timeout=30)
+        response.raise_for_status()
     except Exception as e:
         print_error(f"Failed to fetch game page: {e}")
         return None
     
-    # Parse HTML to find embedded game iframe
-    soup = BeautifulSoup(html, 'html.parser')
+    # Parse HTML to find embedded game iframe. The raw bytes go straight to the
+    # parser so lxml decodes them natively instead of building a str first.
+    soup = BeautifulSoup(response.content, HTML_PARSER, from_encoding='utf-8')
     
-    # Look for iframe with embedded game
+    # Look for iframe with embedded game, collecting the iframes in one walk
+    # of the tree and then checking them in order of preference
+    iframes = [iframe for iframe in soup.find_all('iframe') if iframe.get('src')]
     iframe_patterns = [
-        'iframe[src*="html-classic.itch.zone"]',
-        'iframe[src*="itch.zone"]',
-        'iframe[id="game_drop"]'
+        lambda iframe: 'html-classic.itch.zone' in iframe['src'],
+        lambda iframe: 'itch.zone' in iframe['src'],
+        lambda iframe: iframe.get('id') == 'game_drop'
     ]
     
     for pattern in iframe_patterns:
-        iframe = soup.select_one(pattern)
-        if iframe and iframe.get('src'):
-            game_iframe_url = iframe.get('src')
+        iframe = next(filter(pattern, iframes), None)
+        if iframe:
+            game_iframe_url = iframe['src']
             print_status(f"Found embedded game URL: {game_iframe_url}")
             return game_iframe_url
     
@@ -80,7 +131,7 @@ def find_embedded_game_url(game_url):
     if placeholder and placeholder.get('data-iframe'):
         iframe_html = placeholder.get('data-iframe')
         # Parse the iframe HTML to extract src
-        iframe_soup = BeautifulSoup(iframe_html, 'html.parser')
+        iframe_soup = BeautifulSoup(iframe_html, HTML_PARSER)
         iframe = iframe_soup.find('iframe')
         if iframe and iframe.get('src'):
             game_iframe_url = iframe.get('src')
@@ -90,8 +141,100 @@ def find_embedded_game_url(game_url):
     print_error("Could not find embedded HTML5 game. Game might not have a web version.")
     return None
 
-def download_and_extract_embedded_game(game_iframe_url, temp_dir):
-    """Download the HTML5 game files from the embedded URL"""
+def reuse_previous_asset(asset_url, full_url, local_path, previous_dir):
+    """Link an asset from a previous download into place if its size is unchanged"""
+    # fix_url_encoded_filenames may have decoded the name on the previous run
+    for name in (asset_url, urllib.parse.unquote(asset_url)):
+        previous_path = os.path.join(previous_dir, name)
+        if os.path.isfile(previous_path):
+            break
+    else:
+        return False
+    
+    try:
+        response = SESSION.head(full_url, headers=ASSET_HEADERS, allow_redirects=True, timeout=30)
+        response.raise_for_status()
+    except requests.RequestException:
+        # Servers that reject or time out on HEAD just mean a fresh download
+        return False
+    try:
+        remote_size = int(response.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return False
+    if remote_size != os.path.getsize(previous_path):
+        return False
+    
+    try:
+        os.link(previous_path, local_path)
+    except OSError:
+        shutil.copy2(previous_path, local_path)
+    return True
+
+def fetch_asset(full_url, local_path):
+    """Stream an asset to local_path, retrying if the transfer drops"""
+    headers = ASSET_HEADERS
+    resumable = False
+    with open(local_path, 'wb') as f:
+        for attempt in range(MAX_RESUME_ATTEMPTS + 1):
+            try:
+                with SESSION.get(full_url, headers=headers, stream=True, timeout=30) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        # Full body (first attempt, or the file changed upstream)
+                        f.seek(0)
+                        f.truncate()
+                        # Only resume when there is a validator to send as If-Range
+                        validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+                        resumable = bool(validator)
+                    # Copy the undecoded body in 1 MiB chunks
+                    response.raw.decode_content = False
+                    shutil.copyfileobj(response.raw, f, 1 << 20)
+                break
+            except (requests.ConnectionError, requests.Timeout, ProtocolError, ReadTimeoutError):
+                if attempt == MAX_RESUME_ATTEMPTS:
+                    raise
+                if resumable:
+                    headers = {**ASSET_HEADERS, 'Range': f'bytes={f.tell()}-', 'If-Range': validator}
+                else:
+                    # No validator to check the partial bytes against, so
+                    # fetch the whole file again; the 200 truncates it
+                    headers = ASSET_HEADERS
+        
+        # Build files are written once and only read back later by the
+        # browser. DONTNEED kicks off write-back without waiting for it and
+        # drops whatever is already clean; pages still being written out are
+        # left to age out of the page cache normally.
+        if hasattr(os, 'posix_fadvise'):
+            f.flush()
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def download_asset(asset_url, full_url, local_path, previous_dir=None):
+    """Download a single game asset, reusing an unchanged copy from previous_dir
+
+    Returns True if the asset is in place, False if it could not be fetched.
+    """
+    try:
+        if previous_dir and reuse_previous_asset(asset_url, full_url, local_path, previous_dir):
+            print_status(f"Unchanged, reusing: {asset_url}")
+            return True
+        print_status(f"Downloading: {asset_url}")
+        fetch_asset(full_url, local_path)
+        return True
+    except Exception as e:
+        print_warning(f"Failed to download {asset_url}: {e}")
+        # Don't leave an empty or truncated file looking like a real asset
+        if os.path.exists(local_path):
+            os.remove(local_path)
+        return False
+
+def download_and_extract_embedded_game(game_iframe_url, temp_dir, previous_dir=None):
+    """Download the HTML5 game files from the embedded URL
+
+    Assets whose size is unchanged since a previous download into previous_dir
+    are reused instead of fetched again. Returns None if the page could not be
+    downloaded, or if any asset failed while a previous download exists (so it
+    is not replaced by an incomplete one).
+    """
     print_status(f"Downloading embedded game from: {game_iframe_url}")
     
     # URL encode the iframe URL to handle spaces and special characters
@@ -99,14 +242,15 @@ def download_and_extract_embedded_game(game_iframe_url, temp_dir):
     
     try:
         # Get the game's index.html
-        with urllib.request.urlopen(encoded_url) as response:
-            html_content = response.read().decode('utf-8')
+        response = SESSION.get(encoded_url, timeout=30)
+        response.raise_for_status()
+        html_content = response.content.decode('utf-8')
     except Exception as e:
         print_error(f"Failed to download game HTML: {e}")
         return None
     
     # Parse the HTML to find all assets (JS, WASM, data files)
-    soup = BeautifulSoup(html_content, 'html.parser')
+    soup = BeautifulSoup(html_content, HTML_PARSER)
     
     # Extract base URL from the iframe URL (removing query params and filename)
     base_url = '/'.join(game_iframe_url.split('?')[0].split('/')[:-1]) + '/'
@@ -130,25 +274,25 @@ def download_and_extract_embedded_game(game_iframe_url, temp_dir):
         if src and src.startswith('Build/'):
             assets_to_download.append(src)
     
-    # Parse the Unity config object for other assets
-    script_content = str(soup)
-    
-    # Extract URLs from config object
-    config_patterns = [
-        r'dataUrl:\s*["\']([^"\']+)["\']',
-        r'frameworkUrl:\s*["\']([^"\']+)["\']',
-        r'codeUrl:\s*["\']([^"\']+)["\']'
-    ]
-    
-    for pattern in config_patterns:
-        matches = re.findall(pattern, script_content)
-        for match in matches:
-            if match.startswith('Build/'):
-                assets_to_download.append(match)
+    # Parse the Unity config object for other assets in a single scan of the
+    # page source rather than re-serializing the parsed tree
+    build_url_match = UNITY_BUILD_URL_RE.search(html_content)
+    build_url = build_url_match.group(1) if build_url_match else 'Build'
+    for match in UNITY_CONFIG_URL_RE.finditer(html_content):
+        asset_url = match.group(2)
+        if match.group(1):
+            asset_url = build_url + asset_url
+        if asset_url.startswith('Build/'):
+            assets_to_download.append(asset_url)
+    
+    # Drop duplicates (e.g. the loader referenced twice) so no two workers
+    # write the same file concurrently
+    assets_to_download = list(dict.fromkeys(assets_to_download))
     
     print_status(f"Found {len(assets_to_download)} assets to download")
     
-    # Download all assets
+    # Download all assets concurrently over the shared session
+    downloads = []
     for asset_url in assets_to_download:
         # Construct full URL
         full_url = base_url + asset_url
@@ -162,11 +306,21 @@ def download_and_extract_embedded_game(game_iframe_url, temp_dir):
         # Create directory if needed
         os.makedirs(os.path.dirname(local_path), exist_ok=True)
         
-        try:
-            print_status(f"Downloading: {asset_url}")
-            urllib.request.urlretrieve(encoded_asset_url, local_path)
-        except Exception as e:
-            print_warning(f"Failed to download {asset_url}: {e}")
+        downloads.append((asset_url, encoded_asset_url, local_path, previous_dir))
+    
+    with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+        # Create the standalone version while the assets are still downloading
+        standalone_path = os.path.join(game_files_dir, "standalone.html")
+        standalone_future = executor.submit(create_standalone_html, html_path, standalone_path)
+        results = list(executor.map(lambda download: download_asset(*download), downloads))
+    standalone_future.result()
+    
+    failed = results.count(False)
+    if failed and previous_dir:
+        print_error(f"Failed to download {failed} of {len(downloads)} assets")
+        return None
+    if failed:
+        print_warning(f"Failed to download {failed} of {len(downloads)} assets; the game may not load")
     
     return game_files_dir
 
@@ -206,8 +360,7 @@ def create_standalone_html(original_html_path, standalone_html_path):
         content = f.read()
     
     # Remove itch.io script references
-    content = re.sub(r'<script[^>]*itch\.io[^>]*>.*?</script>', '', content, flags=re.DOTALL)
-    content = re.sub(r'<script[^>]*htmlgame\.js[^>]*>.*?</script>', '', content, flags=re.DOTALL)
+    content = ITCH_SCRIPT_RE.sub('', content)
     
     with open(standalone_html_path, 'w', encoding='utf-8') as f:
         f.write(content)
@@ -254,6 +407,35 @@ import os
 PORT = 8080
 
 class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    extensions_map = {
+        **http.server.SimpleHTTPRequestHandler.extensions_map,
+        '.wasm': 'application/wasm',
+    }
+
+    def is_gzipped(self):
+        return self.path.split('?', 1)[0].endswith('.gz')
+
+    def guess_type(self, path):
+        # Pre-compressed Build files keep the type of the file inside the .gz
+        if path.endswith('.gz'):
+            path = path[:-3]
+        return super().guess_type(path)
+
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        # Let the browser gunzip natively instead of Unity's JS fallback
+        if code == 200 and self.is_gzipped():
+            self.send_header('Content-Encoding', 'gzip')
+
+    def copyfile(self, source, outputfile):
+        # Hand large Build files to the kernel (sendfile) instead of copying
+        # them through Python; socket.sendfile falls back to send() if needed
+        if outputfile is self.wfile:
+            self.wfile.flush()
+            self.connection.sendfile(source)
+        else:
+            super().copyfile(source, outputfile)
+
     def end_headers(self):
         self.send_header('Cross-Origin-Embedder-Policy', 'require-corp')
         self.send_header('Cross-Origin-Opener-Policy', 'same-origin')
@@ -290,6 +472,17 @@ def create_game_info(game_dir, game_name, game_url, original_html):
     with open(info_path, 'w', encoding='utf-8') as f:
         json.dump(info, f, indent=2)
 
+def clean_stale_staging_dirs(games_dir, game_name):
+    """Remove staging directories left behind by interrupted runs"""
+    game_dir = games_dir / game_name
+    for stale_dir in games_dir.glob(f".{game_name}.download-*"):
+        # A run killed mid-swap leaves the old download set aside; restore it
+        previous = stale_dir / "previous"
+        if previous.is_dir() and not game_dir.exists():
+            os.rename(previous, game_dir)
+            print_warning(f"Restored previous download from interrupted run: {game_dir}")
+        shutil.rmtree(stale_dir, ignore_errors=True)
+
 def main():
     if len(sys.argv) < 2:
         print_error("Usage: python3 grab_itch_game.py <itch_game_url> [game_name]")
@@ -309,19 +502,24 @@ def main():
     game_dir = games_dir / game_name
     
     games_dir.mkdir(exist_ok=True)
+    clean_stale_staging_dirs(games_dir, game_name)
     
-    # Remove existing game directory if it exists
-    if game_dir.exists():
-        shutil.rmtree(game_dir)
+    # An existing download is kept until the new one is ready so unchanged
+    # assets can be reused from it
+    previous_dir = str(game_dir) if game_dir.exists() else None
     
-    with tempfile.TemporaryDirectory() as temp_dir:
+    # Stage the download next to its final location so it can be moved into
+    # place with a rename instead of copying every file
+    with tempfile.TemporaryDirectory(dir=games_dir, prefix=f".{game_name}.download-") as temp_dir:
         # Find and download the game
         game_iframe_url = find_embedded_game_url(game_url)
         if not game_iframe_url:
             sys.exit(1)
         
-        extracted_dir = download_and_extract_embedded_game(game_iframe_url, temp_dir)
+        extracted_dir = download_and_extract_embedded_game(game_iframe_url, temp_dir, previous_dir)
         if not extracted_dir:
+            if previous_dir:
+                print_warning(f"Keeping the existing download in {game_dir}")
             sys.exit(1)
         
         # Verify we have the main HTML file
@@ -332,22 +530,26 @@ def main():
         
         print_status("Found embedded game files")
         
-        # Copy all files to game directory
-        game_dir.mkdir(parents=True)
-        
-        # Copy the extracted game files to our game directory
-        shutil.copytree(extracted_dir, game_dir, dirs_exist_ok=True)
+        # Swap the extracted game files in. The previous download is moved
+        # aside into the staging directory first (removed with it on exit), so
+        # one copy of the game exists on disk at every point
+        if previous_dir:
+            previous_aside = os.path.join(temp_dir, "previous")
+            os.rename(previous_dir, previous_aside)
+            try:
+                os.rename(extracted_dir, game_dir)
+            except OSError:
+                os.rename(previous_aside, previous_dir)
+                raise
+        else:
+            os.rename(extracted_dir, game_dir)
         
         # Fix URL-encoded filenames
         build_dir = game_dir / "Build"
         fix_url_encoded_filenames(str(build_dir))
         
-        # Create standalone version
-        original_html = game_dir / "index.html"
-        standalone_html = game_dir / "standalone.html"
-        create_standalone_html(str(original_html), str(standalone_html))
-        
         # Create launcher and support files
+        original_html = game_dir / "index.html"
         create_launcher_html(str(game_dir))
         create_test_server(str(game_dir))
         create_game_info(str(game_dir), game_name, game_url, str(original_html))